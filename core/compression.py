@@ -5,13 +5,18 @@ import os
 import copy
 
 class Compression():
+    # where 7z.exe was found, shared by all instances - the search below walks every drive,
+    # so it should happen at most once per process
+    exe_7zip_path_found = None
+
     def __init__(self, password, verbose = False):
         self.password = password
         self.verbose = verbose
-        self.exe_7zip_path = self.get_7zip_exe()
+        if Compression.exe_7zip_path_found is None:
+            Compression.exe_7zip_path_found = self.get_7zip_exe()
+        self.exe_7zip_path = Compression.exe_7zip_path_found
 
     def get_7zip_exe(self):
-        # todo: store off the path so we don't have to scan every time
         drives = win32api.GetLogicalDriveStrings()
         drives = drives.split('\000')[:-1]
         for drive in drives:
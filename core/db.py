@@ -8,10 +8,28 @@ import core.walker
 import core.hash
 import core.const
 import datetime
+import functools
+import heapq
+import concurrent.futures
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
 import sqlalchemy.ext.declarative
 
+try:
+    import sqlalchemy.ext.baked
+    # baked queries cache their compiled SQL, so the repeated identical-shape lookups on the
+    # scan path skip statement compilation entirely (removed in SQLAlchemy 2.0, hence the guard)
+    _bakery = sqlalchemy.ext.baked.bakery()
+except ImportError:
+    _bakery = None
+
+# memoized os.path.abspath - abspath does a getcwd() plus string normalization every call, and
+# the per-file/per-query paths below hand it the same handful of roots over and over.  Caching it
+# also pins a root's absolute form for the life of the process, so a cwd change mid-scan can't
+# silently redirect half the rows.
+_abspath = functools.lru_cache(maxsize=None)(os.path.abspath)
+
 Base = sqlalchemy.ext.declarative.declarative_base()
 
 class Roots(Base):
@@ -36,11 +54,17 @@ class Files(Base):
     __tablename__ = 'files'
     absroot = sqlalchemy.Column(sqlalchemy.String, sqlalchemy.ForeignKey("roots.absroot"))
     path = sqlalchemy.Column(sqlalchemy.String) # path (off of root) for this file
-    sha512 = sqlalchemy.Column(sqlalchemy.String) # sha512 for this file - None if deleted
+    sha512 = sqlalchemy.Column(sqlalchemy.LargeBinary(64)) # sha512 (raw digest bytes) for this file - None if deleted
+    # the fast hash (blake3 when installed, else the sha512), raw digest bytes - used for
+    # same-machine dedup and comparisons; keep sha512 for anything that crosses nodes
+    fast_hash = sqlalchemy.Column(sqlalchemy.LargeBinary(64))
     size = sqlalchemy.Column(sqlalchemy.BigInteger) # size of this file - None if delete
     mtime = sqlalchemy.Column(sqlalchemy.DateTime) # most recent modification time of this file (UTC) - None if deleted
     hidden = sqlalchemy.Column(sqlalchemy.Boolean) # does this file have the hidden attribute set?
     system = sqlalchemy.Column(sqlalchemy.Boolean) # does this file have the system attribute set?
+    # True only on the most recent row for each (absroot, path) - maintained on insert, so
+    # "latest version" queries don't have to sort the whole history by count
+    is_latest = sqlalchemy.Column(sqlalchemy.Boolean)
     count = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True) # todo: be careful with this if we do a trim on this table
 
     @property
@@ -50,6 +74,14 @@ class Files(Base):
         """
         return os.path.join(self.absroot, self.path)
 
+# the "latest row for a path" lookup is the hot query - give it a covering index
+sqlalchemy.Index('ix_files_absroot_path_count', Files.absroot, Files.path, Files.count)
+# hash lookups (get_paths_from_hash, difference/intersection subqueries) and the is_latest
+# filters would otherwise scan the whole change history
+sqlalchemy.Index('ix_files_sha512', Files.sha512)
+sqlalchemy.Index('ix_files_fast_hash', Files.fast_hash)
+sqlalchemy.Index('ix_files_is_latest', Files.is_latest)
+
 class HashPerf(Base):
     """
     Hash calculation performance.  This is a separate table since we only keep the longest N times.
@@ -59,6 +91,20 @@ class HashPerf(Base):
     size = sqlalchemy.Column(sqlalchemy.BigInteger) # size of this file
     time = sqlalchemy.Column(sqlalchemy.Float) # time in seconds to took to calculate the hash
 
+class StatCache(Base):
+    """
+    Content identity keyed by (device, inode) with the size/mtime observed when the contents were
+    last hashed.  Lets a scan recognize a file that was merely renamed or hardlinked within a root
+    and reuse its hashes instead of re-reading the whole file.
+    """
+    __tablename__ = 'statcache'
+    dev = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    ino = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
+    size = sqlalchemy.Column(sqlalchemy.BigInteger)
+    mtime_ns = sqlalchemy.Column(sqlalchemy.BigInteger) # st_mtime_ns - full resolution, unlike Files.mtime
+    sha512 = sqlalchemy.Column(sqlalchemy.LargeBinary(64))
+    fast_hash = sqlalchemy.Column(sqlalchemy.LargeBinary(64))
+
 class Request(Base):
     """
     When a node needs a file, the request is put in this table (and removed by the requesting node when fulfilled).
@@ -80,6 +126,17 @@ class FilePath:
         self.absroot = absroot
         self.path = path
 
+    # value semantics on (absroot, path) so FilePaths work properly in sets and dicts
+    # (identity comparison made membership tests silently O(N) and never equal)
+    def __eq__(self, other):
+        return isinstance(other, FilePath) and self.absroot == other.absroot and self.path == other.path
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.absroot, self.path))
+
     @property
     def abspath(self):
         """
@@ -87,6 +144,37 @@ class FilePath:
         """
         return os.path.join(self.absroot, self.path)
 
+def compute_file_row(absroot, rel_path, stat_cache = None):
+    """
+    Compute the Files row values for a single file (stat, hidden/system attributes, hash).
+    Does not touch the database, so it's safe to call outside of a session (e.g. from workers).
+    :param absroot: absolute path of the root folder for the file
+    :param rel_path: relative path of the file
+    :param stat_cache: optional dict of (dev, ino, size, mtime_ns) to (sha512, fast_hash) - on a
+    match the hashes are reused without reading the file, so renames/hardlinks cost one stat
+    :return: dict of Files column values, plus the 'sha512_time' and 'stat_identity' bookkeeping
+    values (pop them before handing the dict to an insert - 'sha512_time' is None when the hash
+    was not timed or came from the cache), or None if the file could not be read
+    """
+    full_path = os.path.join(absroot, rel_path)
+    if core.util.is_locked(full_path):
+        return None
+    st = os.stat(full_path) # one syscall for everything - size, mtime, and the content identity
+    mtime = datetime.datetime.utcfromtimestamp(st.st_mtime)
+    size = st.st_size
+    stat_identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = stat_cache.get(stat_identity) if stat_cache else None
+    if cached is not None:
+        sha512, fast_hash = cached
+        sha512_time = None
+    else:
+        is_big = size >= core.const.BIG_FILE_SIZE # only time big files
+        sha512, fast_hash, sha512_time = core.hash.calc_hashes(full_path, is_big)
+    return {'absroot' : absroot, 'path' : rel_path, 'sha512' : sha512, 'fast_hash' : fast_hash,
+            'size' : size, 'mtime' : mtime,
+            'hidden' : core.util.is_hidden(full_path), 'system' : core.util.is_system(full_path),
+            'is_latest' : True, 'sha512_time' : sha512_time, 'stat_identity' : stat_identity}
+
 # todo: make 'hidden' and 'system' use or ignore directives part of the class invocation (not a function param)\
 # or perhaps create a 'query class' that holds these, but the DB class would not hold 'root'
 
@@ -103,6 +191,25 @@ class DB:
 
         self.sqlite_db_path = 'sqlite:///' + "/".join(metadata_path.db_folder_as_list) + "/" + id + self.DB_EXT
         self.engine = sqlalchemy.create_engine(self.sqlite_db_path)
+
+        # Tune sqlite for our access pattern (frequent small commits during scans).  WAL avoids an
+        # fsync per commit and lets readers proceed while we write.  Only applies to file-backed
+        # databases - ':memory:' has no journal to speak of.
+        if ':memory:' not in self.sqlite_db_path:
+            @sqlalchemy.event.listens_for(self.engine, 'connect')
+            def _set_sqlite_pragmas(dbapi_conn, connection_record):
+                cursor = dbapi_conn.cursor()
+                # 16 KiB pages fit far more of our long-hash rows per page than the 4 KiB default;
+                # only takes effect on a fresh database (it's a no-op once tables exist), which is
+                # fine - that's when we create the schema
+                cursor.execute('PRAGMA page_size=16384')
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA synchronous=NORMAL') # durable enough with WAL, far fewer fsyncs
+                cursor.execute('PRAGMA temp_store=MEMORY')
+                cursor.execute('PRAGMA mmap_size=1073741824') # 1 GiB - reads come straight from the page cache
+                cursor.execute('PRAGMA cache_size=-131072') # 128 MiB
+                cursor.close()
+
         Session = sqlalchemy.orm.sessionmaker(bind=self.engine)
         self.session = Session()
 
@@ -121,10 +228,37 @@ class DB:
 
         self.commit()
 
+        # roots are essentially static for the life of this instance - cache them so put_file_info
+        # and scan_bulk don't pay a COUNT query per call
+        self._known_roots = set(root.absroot for root in self.session.query(Roots).all())
+
+        # mirror of the HashPerf table as a (time, abspath) min-heap, so set_hash_perf can decide
+        # top-N membership without a COUNT plus a sort query per big file
+        self._hash_perf_heap = [(row.time, row.abspath) for row in self.session.query(HashPerf).all()]
+        heapq.heapify(self._hash_perf_heap)
+
+    def _ensure_root(self, absroot):
+        """
+        Make sure a Roots row exists for absroot, consulting the in-memory cache first.
+        :param absroot: absolute root folder path
+        """
+        if absroot not in self._known_roots:
+            self.session.add(Roots(absroot=absroot))
+            self._known_roots.add(absroot)
+            self._commit_nofsync()
+
     def commit(self):
         self.session.query(Common).filter(Common.key == 'updatetime').update({"val" : str(datetime.datetime.utcnow())})
         self.session.commit()
 
+    def _commit_nofsync(self):
+        """
+        Commit without touching common.updatetime.  For intermediate commits inside bulk
+        operations - the extra UPDATE per commit is measurable on small-file scans, and
+        one timestamp per scan (the final commit()) is all anybody needs.
+        """
+        self.session.commit()
+
     def close(self):
         self.session.close()
 
@@ -146,36 +280,90 @@ class DB:
         :return: True if database modified
         """
         modified = False
-        absroot = os.path.abspath(root)
+        absroot = _abspath(root)
         del root # make sure we don't use the non-abs version of root
-        if self.session.query(Roots).filter(Roots.absroot == absroot).count() == 0:
-            self.session.add(Roots(absroot=absroot))
-            self.commit()
+        self._ensure_root(absroot)
 
         full_path = os.path.join(absroot, rel_path)
         # todo: handle when file deleted
         if not core.util.is_locked(full_path):
-            mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(full_path))
-            size = os.path.getsize(full_path)
+            st = os.stat(full_path) # one stat - size and mtime both come from it
+            mtime = datetime.datetime.utcfromtimestamp(st.st_mtime)
+            size = st.st_size
             # get the most recent row for this file
-            db_entry = self.session.query(Files).filter(Files.absroot == absroot, Files.path == rel_path).order_by(-Files.count).first()
+            db_entry = self._latest_file_entry(absroot, rel_path)
             # Test to see if the file is new or has been updated.
             # On the same (i.e. local) file system, for a given file path, if the mtime is the same then the contents
             # are assumed to be the same.  Note that there is some debate if file size is necessary here, but I'll
             # use it just to be safe.
             if db_entry is None or db_entry.size != size or self.is_time_different(db_entry.mtime, mtime):
-                hidden = core.util.is_hidden(full_path)
-                system = core.util.is_system(full_path)
-                is_big = size >= core.const.BIG_FILE_SIZE # only time big files
-                sha512, sha512_time = core.hash.calc_sha512(full_path, is_big)
-                if is_big:
-                    self.set_hash_perf(absroot, rel_path, size, sha512_time)
-                file_info = Files(absroot=absroot, path=rel_path, sha512=sha512, size=size, mtime=mtime, hidden=hidden, system=system)
-                self.session.add(file_info)
-                self.commit()
-                modified = True
+                row = compute_file_row(absroot, rel_path)
+                if row is not None:
+                    sha512_time = row.pop('sha512_time')
+                    stat_identity = row.pop('stat_identity')
+                    if sha512_time is not None:
+                        self.set_hash_perf(absroot, rel_path, row['size'], sha512_time)
+                    self._remember_stat_identity(stat_identity, row['sha512'], row['fast_hash'])
+                    self._demote_latest(absroot, [rel_path])
+                    self.session.add(Files(**row))
+                    self.commit()
+                    modified = True
         return modified
 
+    def _latest_file_entry(self, absroot, rel_path):
+        """
+        Most recent Files row for (absroot, rel_path).  This runs once per file on the
+        single-file put path, so use a baked query when available.
+        """
+        if _bakery is not None:
+            bq = _bakery(lambda session: session.query(Files))
+            bq += lambda q: q.filter(Files.absroot == sqlalchemy.bindparam('absroot'),
+                                     Files.path == sqlalchemy.bindparam('path'),
+                                     Files.is_latest == True)
+            return bq(self.session).params(absroot=absroot, path=rel_path).first()
+        return self.session.query(Files).filter(Files.absroot == absroot, Files.path == rel_path,
+                                                Files.is_latest == True).first()
+
+    def _remember_stat_identity(self, stat_identity, sha512, fast_hash):
+        """
+        Record the hashes for this (dev, ino, size, mtime_ns) so later scans can recognize the
+        same contents after a rename or hardlink without rehashing.
+        """
+        if sha512 is None:
+            return
+        dev, ino, size, mtime_ns = stat_identity
+        self.session.merge(StatCache(dev=dev, ino=ino, size=size, mtime_ns=mtime_ns,
+                                     sha512=sha512, fast_hash=fast_hash))
+
+    # sqlite's historical bound-variable limit is 999, so stay under it for IN () lists
+    DEMOTE_CHUNK_SIZE = 500
+
+    def _demote_latest(self, absroot, paths):
+        """
+        Clear the is_latest flag on the current latest rows for these paths (called just
+        before inserting their replacement rows).
+        :param absroot: absolute root folder path
+        :param paths: list of relative paths about to get new rows
+        """
+        for chunk_start in range(0, len(paths), self.DEMOTE_CHUNK_SIZE):
+            chunk = paths[chunk_start:chunk_start + self.DEMOTE_CHUNK_SIZE]
+            self.session.query(Files).filter(Files.absroot == absroot, Files.is_latest == True,
+                                             Files.path.in_(chunk)).\
+                update({Files.is_latest : False}, synchronize_session=False)
+
+    def get_latest_file_infos(self, root):
+        """
+        The latest known (size, mtime, sha512) for every path in a root, fetched with a single
+        statement as plain column tuples - no per-row ORM object or identity-map work, which is
+        what makes this usable as the preload for a whole-folder scan.
+        :param root: folder
+        :return: dict of path to (size, mtime, sha512)
+        """
+        absroot = _abspath(root)
+        rows = self.session.query(Files.path, Files.size, Files.mtime, Files.sha512).\
+            filter(Files.absroot == absroot, Files.is_latest == True)
+        return dict((path, (size, mtime, sha512)) for path, size, mtime, sha512 in rows)
+
     def get_file_info(self, rel_path):
         """
         Get a single file's info from the database
@@ -185,10 +373,16 @@ class DB:
         db_entry = None
         if rel_path is None:
             self.log.warning("rel_path is None")
+        elif _bakery is not None:
+            bq = _bakery(lambda session: session.query(Files))
+            bq += lambda q: q.filter(Files.path == sqlalchemy.bindparam('path'),
+                                     Files.is_latest == True).order_by(-Files.count)
+            db_entry = bq(self.session).params(path=rel_path).first()
         else:
-            db_entry = self.session.query(Files).filter(Files.path == rel_path).order_by(-Files.count).first()
-            if db_entry is None:
-                self.log.warning('not found in db:' + rel_path)
+            db_entry = self.session.query(Files).filter(Files.path == rel_path, Files.is_latest == True).\
+                order_by(-Files.count).first()
+        if db_entry is None and rel_path is not None:
+            self.log.warning('not found in db:' + rel_path)
         return db_entry
 
     def __iter__(self):
@@ -196,36 +390,89 @@ class DB:
         iterator for all files in this database
         :return: Files class instance with file info
         """
-        # find all the file paths (there has to be a way to just directly query the DB, but this works for now ...)
-        file_paths = []
-        for db_files in self.session.query(Files).all():
-            file_path = FilePath(db_files.absroot, db_files.path)
-            if file_path not in file_paths:
-                file_paths.append(file_path)
-        for file_path in file_paths:
-            # return the most recent entry
-            yield self.session.query(Files).filter(Files.absroot == file_path.absroot, Files.path == file_path.path).\
-                order_by(-Files.count).first()
+        # every path's most recent entry carries the is_latest flag, so this is one indexed pass
+        # instead of a query per path
+        for db_file in self.session.query(Files).filter(Files.is_latest == True).yield_per(1000):
+            yield db_file
 
     def scan(self, absroot):
         """
         Scan folder/directory absroot into DB.
         :param absroot: folder path
         """
+        self.scan_bulk(absroot)
 
-        # check for deletions
-        for file_record in self.session.query(Files).filter(Files.absroot == absroot).order_by(-Files.count):
-            if not os.path.exist(file_record.abspath):
-                # todo: I don't like having the db access in this function - make a new one, I think, so it
-                # looks like the loop below.
-                file_info = Files(absroot=absroot, path=file_record.relpath, sha512=None, size=None, mtime=None)
-                self.session.add(file_info)
-                self.commit()
+    SCAN_INSERT_CHUNK_SIZE = 1000
 
-        # scan file system
-        source_walker = core.walker.Walker(absroot)
-        for file_path in source_walker:
-            self.put_file_info(file_path, absroot)
+    def scan_bulk(self, root):
+        """
+        Scan folder/directory root into the DB using batched inserts and a single commit,
+        instead of one INSERT + one COMMIT round trip per file.
+        :param root: folder path
+        """
+        absroot = _abspath(root)
+        del root # make sure we don't use the non-abs version of root
+        self._ensure_root(absroot)
+
+        # one query for the latest known size/mtime per path, rather than one query per file
+        existing = self.get_latest_file_infos(absroot)
+
+        on_disk = set()
+        to_compute = []
+        for rel_path in core.walker.Walker(absroot):
+            on_disk.add(rel_path)
+            db_size_mtime = existing.get(rel_path)
+            if db_size_mtime is not None:
+                try:
+                    st = os.stat(os.path.join(absroot, rel_path))
+                except OSError:
+                    # deleted (or unreadable) between the walk and now - treat it as gone so the
+                    # tombstone pass below records the deletion, and keep scanning
+                    on_disk.discard(rel_path)
+                    continue
+                mtime = datetime.datetime.utcfromtimestamp(st.st_mtime)
+                if db_size_mtime[0] == st.st_size and not self.is_time_different(db_size_mtime[1], mtime):
+                    continue # unchanged - nothing to record
+            to_compute.append(rel_path)
+
+        # contents we've hashed before under another name (or before a rename) are recognized
+        # by their stat identity and don't need to be read again
+        stat_cache = dict(((row.dev, row.ino, row.size, row.mtime_ns), (row.sha512, row.fast_hash))
+                          for row in self.session.query(StatCache))
+
+        # compute_file_row never touches the session and the hash's update() releases the GIL,
+        # so the changed files stat+hash in parallel, one worker per core
+        if len(to_compute) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                computed = list(executor.map(lambda rel_path: compute_file_row(absroot, rel_path, stat_cache),
+                                             to_compute))
+        else:
+            computed = [compute_file_row(absroot, rel_path, stat_cache) for rel_path in to_compute]
+
+        new_rows = []
+        for row in computed:
+            if row is not None:
+                sha512_time = row.pop('sha512_time')
+                stat_identity = row.pop('stat_identity')
+                if sha512_time is not None:
+                    self.set_hash_perf(absroot, row['path'], row['size'], sha512_time)
+                if stat_identity not in stat_cache:
+                    self._remember_stat_identity(stat_identity, row['sha512'], row['fast_hash'])
+                new_rows.append(row)
+
+        # check for deletions - a set difference against the walk we just did, instead of an
+        # existence check syscall per database row
+        for path, (size, mtime, sha512) in existing.items():
+            if path not in on_disk and sha512 is not None: # sha512 None means already recorded as deleted
+                new_rows.append({'absroot' : absroot, 'path' : path, 'sha512' : None, 'fast_hash' : None,
+                                 'size' : None, 'mtime' : None, 'hidden' : None, 'system' : None,
+                                 'is_latest' : True})
+
+        self._demote_latest(absroot, [row['path'] for row in new_rows if row['path'] in existing])
+        for chunk_start in range(0, len(new_rows), self.SCAN_INSERT_CHUNK_SIZE):
+            self.session.execute(Files.__table__.insert(), new_rows[chunk_start:chunk_start + self.SCAN_INSERT_CHUNK_SIZE])
+            self._commit_nofsync()
+        self.commit() # stamp common.updatetime once for the whole scan
 
     def get_common(self, key):
         """
@@ -246,17 +493,26 @@ class DB:
         """
         # print("hash_perf", absroot, path, size, time)
         used = False
+        abspath = os.path.join(absroot, path)
+        # a re-hashed file may already have an entry - drop the stale one first (the heap is
+        # only MAX_HASH_PERF_VALUES long, so the linear scan is nothing)
+        for i, (_, heap_path) in enumerate(self._hash_perf_heap):
+            if heap_path == abspath:
+                del self._hash_perf_heap[i]
+                heapq.heapify(self._hash_perf_heap)
+                break
         # The table holds only the largest values we've seen.  So if this time is shorter than the shortest time in
-        # the table, ignore it.
-        full = self.session.query(HashPerf).count() >= core.const.MAX_HASH_PERF_VALUES
-        shortest_time_row = self.session.query(HashPerf).order_by(HashPerf.time).first()
-        if not full or shortest_time_row is None or time > shortest_time_row.time:
+        # the table, ignore it.  The in-memory heap mirrors the table, so no queries are needed to decide.
+        full = len(self._hash_perf_heap) >= core.const.MAX_HASH_PERF_VALUES
+        if not full or time > self._hash_perf_heap[0][0]:
             if full:
                 # if we're full, first delete the entry with the shortest time
-                self.session.delete(shortest_time_row)
-            hash_perf = HashPerf(abspath=os.path.join(absroot, path), size=size, time=time)
-            self.session.add(hash_perf)
-            self.commit()
+                _, shortest_path = heapq.heappop(self._hash_perf_heap)
+                self.session.query(HashPerf).filter(HashPerf.abspath == shortest_path).delete()
+            heapq.heappush(self._hash_perf_heap, (time, abspath))
+            self.session.merge(HashPerf(abspath=abspath, size=size, time=time))
+            # no commit here - the callers (scan_bulk, put_file_info) commit, so perf rows ride
+            # along with the file rows
             used = True
         return used
 
@@ -266,14 +522,21 @@ class DB:
         """
         return self.session.query(HashPerf).all()
 
-    def get_paths_from_hash(self, absroot, sha512):
+    def get_paths_from_hash(self, absroot, hash_val):
         """
-        get all of the paths in folder absroot that have a certain hash value
+        get all of the paths in folder absroot that have a certain fast hash value
         :param absroot: root folder to search into
-        :param sha512: hash value (string)
+        :param hash_val: fast hash value (string)
         :return: list of paths to files than have the provided hash value
         """
-        return [FilePath(f.absroot, f.path) for f in self.session.query(Files).filter_by(absroot=absroot, sha512=sha512).all()]
+        if _bakery is not None:
+            bq = _bakery(lambda session: session.query(Files))
+            bq += lambda q: q.filter(Files.absroot == sqlalchemy.bindparam('absroot'),
+                                     Files.fast_hash == sqlalchemy.bindparam('hash_val'))
+            found = bq(self.session).params(absroot=absroot, hash_val=hash_val).all()
+        else:
+            found = self.session.query(Files).filter_by(absroot=absroot, fast_hash=hash_val).all()
+        return [FilePath(f.absroot, f.path) for f in found]
 
     def get_hashes(self, root, hidden=False, system=False):
         """
@@ -286,13 +549,26 @@ class DB:
         # todo: should we filter to get only the most recent hashes for each path?
         #  We should probably use this class's iterator to get to each path, then return all the hashes for
         #  all of the most recent files.
-        filter_items = self.session.query(Files).filter_by(absroot = os.path.abspath(root))
+        filter_items = self.session.query(Files).filter_by(absroot = _abspath(root))
         if not hidden:
             filter_items = filter_items.filter_by(hidden = False)
         if not system:
             filter_items = filter_items.filter_by(system = False)
         # todo: this is only based on hashes ... allow comparisons based on size and mod time, in case we don't have the hashes calculated
-        return set(f.sha512 for f in filter_items.all())
+        return set(f.fast_hash for f in filter_items.all())
+
+    def _latest_files_query(self, absroot, hidden, system):
+        """
+        Query for the latest, not-deleted Files rows in a root, with the usual hidden/system
+        filtering.  Building block for the set operations below.
+        """
+        q = self.session.query(Files).filter(Files.absroot == absroot, Files.is_latest == True,
+                                             Files.sha512 != None)
+        if not hidden:
+            q = q.filter(Files.hidden == False)
+        if not system:
+            q = q.filter(Files.system == False)
+        return q
 
     def difference(self, root_a, root_b, hidden=False, system=False):
         """
@@ -303,29 +579,32 @@ class DB:
 
         :param root_a: folder a
         :param root_b: folder b
-        :param ignore_hidden: ignore hidden files
-        :param ignore_system: ignore system files
-        :return: files in a that are not in b
-        """
-        a_hashes = self.get_hashes(root_a)
-        b_hashes = self.get_hashes(root_b)
-        # the below just provides one of the files with the correct hash
-        a_minus_b = [self.get_paths_from_hash(os.path.abspath(root_a), h)[0] for h in a_hashes - b_hashes]
-        return a_minus_b
+        :param hidden: include hidden files
+        :param system: include system files
+        :return: files in a that are not in b (one per distinct content)
+        """
+        # one statement instead of pulling both roots' hashes into Python sets and re-querying
+        # per hash; the group_by keeps the "one file per content" behavior
+        b_hashes = self._latest_files_query(_abspath(root_b), hidden, system).\
+            with_entities(Files.fast_hash)
+        q = self._latest_files_query(_abspath(root_a), hidden, system).\
+            filter(~Files.fast_hash.in_(b_hashes)).group_by(Files.fast_hash)
+        return [FilePath(f.absroot, f.path) for f in q]
 
     def intersection(self, root_a, root_b, hidden=False, system=False):
         """
-        Files that are in a or in b.  This is the set '&' operator (AKA intersection).
+        Files that are in a and in b.  This is the set '&' operator (AKA intersection).
         :param root_a: folder a
         :param root_b: folder b
-        :param ignore_hidden: ignore hidden files
-        :param ignore_system: ignore system files
-        :return: files that are the intersection of a and b
+        :param hidden: include hidden files
+        :param system: include system files
+        :return: files that are the intersection of a and b (one per distinct content, from b)
         """
-        a_hashes = self.get_hashes(root_a)
-        b_hashes = self.get_hashes(root_b)
-        intersection = [self.get_paths_from_hash(os.path.abspath(root_b), h)[0] for h in a_hashes & b_hashes]
-        return intersection
+        a_hashes = self._latest_files_query(_abspath(root_a), hidden, system).\
+            with_entities(Files.fast_hash)
+        q = self._latest_files_query(_abspath(root_b), hidden, system).\
+            filter(Files.fast_hash.in_(a_hashes)).group_by(Files.fast_hash)
+        return [FilePath(f.absroot, f.path) for f in q]
 
     def non_uniques(self, root):
         """
@@ -333,12 +612,16 @@ class DB:
         :param root:
         :return:
         """
+        absroot = _abspath(root)
+        # one statement: find the hashes with more than one row, then pull those rows - instead
+        # of fetching every hash and issuing a query per hash (2N round trips for N hashes)
+        dup_hashes = self.session.query(Files.fast_hash).\
+            filter(Files.absroot == absroot, Files.fast_hash != None).\
+            group_by(Files.fast_hash).having(sqlalchemy.func.count() > 1)
         non_unique_files = {}
-        absroot = os.path.abspath(root)
-        for h in self.get_hashes(absroot):
-            paths = self.get_paths_from_hash(absroot, h)
-            if len(paths) > 1:
-                non_unique_files[h] = paths
+        for f in self.session.query(Files).filter(Files.absroot == absroot,
+                                                  Files.fast_hash.in_(dup_hashes)):
+            non_unique_files.setdefault(f.fast_hash, []).append(FilePath(f.absroot, f.path))
         return non_unique_files
 
     def add_request(self, path, nodeid):
@@ -23,28 +23,16 @@ class MetadataPath():
         elif folder_type == LOCAL:
             self.metadata_dir_name = core.const.NAME  # no dot for local folder
         self.metadata_base = metadata_base
+
+        # these get looked at per file in the hot loops, so build each string once here instead
+        # of redoing the joins on every (former property) access
+        self.metadata_dir_path = os.path.join(self.metadata_base, self.metadata_dir_name)
+        self.db_folder_as_list = [self.metadata_base, self.metadata_dir_name, DB_DIR_NAME]
+        self.db_folder = functools.reduce(os.path.join, self.db_folder_as_list)
+        self.cache_folder_as_list = [self.metadata_base, self.metadata_dir_name, CACHE_DIR_NAME]
+        self.cache_folder = functools.reduce(os.path.join, self.cache_folder_as_list)
+
         if not os.path.exists(self.db_folder):
             os.makedirs(self.db_folder)
         if make_hidden:
             core.util.make_hidden(self.metadata_dir_path)
-
-    @property
-    def metadata_dir_path(self):
-        return os.path.join(self.metadata_base, self.metadata_dir_name)
-
-    @property
-    def db_folder(self):
-        return functools.reduce(os.path.join, self.db_folder_as_list)
-
-    @property
-    def db_folder_as_list(self):
-        return [self.metadata_base, self.metadata_dir_name, DB_DIR_NAME]
-
-
-    @property
-    def cache_folder(self):
-        return functools.reduce(os.path.join, self.cache_folder_as_list)
-
-    @property
-    def cache_folder_as_list(self):
-        return [self.metadata_base, self.metadata_dir_name, CACHE_DIR_NAME]
@@ -1,6 +1,9 @@
 
 import os
+import stat
 import json
+import hashlib
+import time
 import threading
 import win32file
 import win32event
@@ -23,23 +26,80 @@ class KBExit(threading.Thread):
     def run(self):
         input('press enter to exit')
 
+class HashCache():
+    """
+    Persistent memo of file hashes keyed by partial path, validated by (mtime_ns, size).  A stat
+    is orders of magnitude cheaper than reading and hashing a whole file, so on a steady-state
+    sync pass this skips nearly all of the disk reads.  Stored as json like the per-file dbs.
+    """
+    def __init__(self, cache_file_path):
+        self.cache_file_path = cache_file_path
+        try:
+            with open(self.cache_file_path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+        self.dirty = False
+
+    def get(self, partial_path, st):
+        """
+        :param partial_path: path of the file relative to the latus folder
+        :param st: os.stat result for the file as it is on disk right now
+        :return: the cached hash (hex) if the file looks unchanged, else None
+        """
+        entry = self.entries.get(partial_path)
+        if entry is not None and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size:
+            return entry['sha512']
+        return None
+
+    def put(self, partial_path, st, sha512):
+        self.entries[partial_path] = {'mtime_ns' : st.st_mtime_ns, 'size' : st.st_size, 'sha512' : sha512}
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            # side file + replace, so dying mid-write leaves the old cache rather than half a one
+            tmp_file_path = self.cache_file_path + '.tmp'
+            with open(tmp_file_path, 'w') as f:
+                json.dump(self.entries, f, indent = 4)
+            os.replace(tmp_file_path, self.cache_file_path)
+            self.dirty = False
+
 class Sync(threading.Thread):
     """
     Determines what needs to be done to sync local to cloud.
     """
     DATABASE_FILE_NAME = '.' + core.const.NAME + '_sync_db' + '.json' # reserved
 
+    # the zip file names only need to be unique, not cryptographically complete, so use the
+    # first 32 bytes of the sha512 (the same truncation as SHA-512/256 - still far beyond any
+    # collision we could produce).  Halves the path and dirent bytes of every archive; the
+    # full hash still travels in the json db.
+    ZIP_NAME_HEX_CHARS = 64
+
+    # how long a lull (in ms) ends a burst of change notifications - editor saves arrive as
+    # several events back to back (temp file, rename, attribute writes) and one sync pass per
+    # burst is plenty
+    DEBOUNCE_WINDOW_MS = 500
+
+    # cap on a whole burst - sustained activity (a big copy into the folder) must not defer
+    # syncing, or shutdown, past this
+    DEBOUNCE_MAX_SECONDS = 5
+
     def __init__(self, password, latus_folder, cloud_root, exit_event_handle = None, appdata_folder = None, verbose = False):
         threading.Thread.__init__(self)
         self.password = password
-        self.cloud_root = cloud_root
+        # normalize the two anchor paths once - everything below is built by joining onto them,
+        # so no per-file abspath (and its getcwd call) is needed anywhere in the sync loops
+        self.cloud_root = os.path.abspath(cloud_root)
         self.exit_event_handle = exit_event_handle
-        self.latus_folder = latus_folder
+        self.latus_folder = os.path.abspath(latus_folder)
+        self.cloud_folder = os.path.join(self.cloud_root, '.' + core.const.NAME) # joined once - it's used per file
         self.verbose = verbose
         if self.verbose:
             print('local_folder', self.latus_folder)
             print('cloud_root', self.cloud_root)
-            print('cloud_folder', self.get_cloud_folder())
+            print('cloud_folder', self.cloud_folder)
 
         core.util.make_dirs(self.latus_folder)
 
@@ -47,12 +107,78 @@ class Sync(threading.Thread):
             # I'd like to use winpaths.get_local_appdata() but it doesn't seem to work with Python 3, so I'll
             # rely on the environment variable.
             self.appdata_folder = os.environ['APPDATA']
+        else:
+            self.appdata_folder = appdata_folder
+
+        # one Compression for the life of this Sync, made on first use (its construction used
+        # to happen per archived file)
+        self.compression = None
+
+        # The hash cache is per-machine state (it's validated by local mtimes), so it lives in
+        # appdata and not in the cloud folder.  Its file name is keyed by the latus folder -
+        # entries are relative paths, so one shared file would let several Syncs on a machine
+        # clobber each other's saves and cross-hit same-named files in different folders.
+        folder_key = hashlib.sha512(self.latus_folder.encode()).hexdigest()[:16]
+        self.hash_cache = HashCache(os.path.join(
+            self.appdata_folder, core.const.NAME + '_hash_cache_' + folder_key + '.json'))
+
+        # parsed per-file json dbs keyed by db file path -> (mtime_ns, data).  The cloud pass
+        # re-reads the same dbs every sweep and they rarely change, so a stat decides whether
+        # the parse can be skipped.  Another node updating a db bumps its mtime and misses here.
+        self._db_cache = {}
+
+        # per-sweep snapshot of cloud directory listings, folder -> set of names.  One readdir
+        # replaces a stat per file, which matters on the network filesystems cloud folders tend
+        # to live on.  Cleared at the start of every sync so other nodes' writes get seen.
+        self._dir_listings = {}
+
+        # db file path -> (mtime_ns, local path) of dbs whose latest version we've fully dealt
+        # with (the local copy was in place at the end of the sweep).  Lets the cloud pass skip
+        # settled folders with two stats - db unchanged, local copy still there - instead of
+        # re-deciding the merge for every folder on every sweep.
+        self._cloud_settled = {}
 
     def get_cloud_folder(self):
-        return os.path.join(self.cloud_root, '.' + core.const.NAME)
+        return self.cloud_folder
+
+    def get_compression(self):
+        if self.compression is None:
+            self.compression = core.compression.Compression(self.password, self.verbose)
+        return self.compression
+
+    def zip_file_name(self, hash):
+        return hash[:self.ZIP_NAME_HEX_CHARS] + '.zip'
+
+    def _listing(self, folder):
+        """
+        :param folder: cloud-side folder path
+        :return: cached set of the names in folder (empty if it doesn't exist) - callers add the
+        names they create so later checks in the same sweep stay consistent
+        """
+        names = self._dir_listings.get(folder)
+        if names is None:
+            try:
+                names = set(os.listdir(folder))
+            except OSError:
+                names = set()
+            self._dir_listings[folder] = names
+        return names
+
+    # editors and downloaders write under these names and rename into place when done -
+    # syncing them would archive half-written junk
+    TEMP_FILE_SUFFIXES = ('.tmp', '~')
 
     def local_folder_contents(self):
-        return dict([(f, None) for f in os.listdir (self.latus_folder)])
+        # name -> mtime_ns, so the diff sees in-place modifications and not just renames
+        contents = {}
+        for f in os.listdir(self.latus_folder):
+            if f.endswith(self.TEMP_FILE_SUFFIXES):
+                continue
+            try:
+                contents[f] = os.stat(os.path.join(self.latus_folder, f)).st_mtime_ns
+            except OSError:
+                pass # vanished while listing - almost certainly a temp file
+        return contents
 
     def run(self):
         #
@@ -61,10 +187,14 @@ class Sync(threading.Thread):
         #  watched; the second is a boolean indicating whether the
         #  directories underneath the one specified are to be watched;
         #  the third is a list of flags as to what kind of changes to
-        #  watch for. We're just looking at file additions / deletions.
+        #  watch for.  We watch the subtree (the sync pass handles nested
+        #  files, so the watch has to see them too) for name changes and
+        #  content writes - nothing else can need a sync, so anything
+        #  more (attributes, accesses) would just be wakeups to ignore.
         #
-        change_handle = win32file.FindFirstChangeNotification(self.latus_folder, 0,
-                                                              win32con.FILE_NOTIFY_CHANGE_FILE_NAME)
+        change_handle = win32file.FindFirstChangeNotification(self.latus_folder, 1,
+                                                              win32con.FILE_NOTIFY_CHANGE_FILE_NAME |
+                                                              win32con.FILE_NOTIFY_CHANGE_LAST_WRITE)
 
         # This order is important.  If multiple events are triggered, only the lowest index is
         # indicated.  So, the exit event must be the lowest index or else we could miss
@@ -72,6 +202,7 @@ class Sync(threading.Thread):
         wait_objects = [change_handle]
         if self.exit_event_handle is not None:
             wait_objects.insert(0, self.exit_event_handle) # prepend
+        change_index = win32con.WAIT_OBJECT_0 + len(wait_objects) - 1 # the change handle's result value
 
         #
         # Loop forever, listing any file changes. The WaitFor... will
@@ -81,6 +212,7 @@ class Sync(threading.Thread):
         exit_flag = False
         try:
             old_path_contents = self.local_folder_contents()
+            self.sync() # one full pass at startup; after this the watch keeps us incremental
             while not exit_flag:
                 result = win32event.WaitForMultipleObjects(wait_objects, 0, 10 * 1000)
                 print('WaitForMultipleObjects', result)
@@ -92,78 +224,226 @@ class Sync(threading.Thread):
                 if result == win32con.WAIT_OBJECT_0:
                     exit_flag = True
                 elif result == win32con.WAIT_OBJECT_0 + 1:
+                    # Drain the rest of the burst before scanning - each extra notification
+                    # inside the window just re-arms the handle instead of costing a sync pass.
+                    # The wait keeps watching the exit event, and the whole drain is capped, so
+                    # sustained writes can neither defer the sync nor block shutdown.
+                    win32file.FindNextChangeNotification(change_handle)
+                    drain_start = time.time()
+                    while time.time() - drain_start < self.DEBOUNCE_MAX_SECONDS:
+                        result = win32event.WaitForMultipleObjects(wait_objects, 0, self.DEBOUNCE_WINDOW_MS)
+                        if result == change_index:
+                            win32file.FindNextChangeNotification(change_handle)
+                        elif result == win32con.WAIT_OBJECT_0:
+                            exit_flag = True # sync what we have below, then the main loop ends
+                            break
+                        else:
+                            break # a lull - the burst is over
                     new_path_contents = self.local_folder_contents()
-                    added = [f for f in new_path_contents if not f in old_path_contents]
+                    added = [f for f in new_path_contents
+                             if new_path_contents[f] != old_path_contents.get(f)]
                     deleted = [f for f in old_path_contents if not f in new_path_contents]
-                    self.sync(added, deleted)
+                    # A change inside a subfolder surfaces here as the subfolder itself (a
+                    # create/delete moves its mtime) or not at all (a content write moves no
+                    # directory mtime) - so the top-level diff is only trustworthy when the
+                    # latus folder is flat.  Any subfolder at all means a full pass, which is
+                    # cheap now that _hash_all is one stat per unchanged file.
+                    flat = all(os.path.isfile(os.path.join(self.latus_folder, f))
+                               for f in new_path_contents)
+                    if (added or deleted) and flat:
+                        self.sync(added, deleted)
+                    else:
+                        self.sync()
                     old_path_contents = new_path_contents
-                    win32file.FindNextChangeNotification(change_handle)
         finally:
             win32file.FindCloseChangeNotification(change_handle)
 
+    def _hash_all(self, local_paths):
+        """
+        Stat every local file and produce its hash.  The hash cache handles the unchanged files;
+        all the cache misses go to core.hash.calc_sha512_batch in one batch, which lanes them
+        across a thread pool so their reads and SHA-512 work overlap.
+        :param local_paths: paths of the files relative to the latus folder
+        :return: list of (partial_path, hash (hex) or None if unreadable, os.stat result)
+        """
+        statted = []
+        hashes = {}
+        misses = []
+        for partial_path in local_paths:
+            if partial_path.endswith(self.TEMP_FILE_SUFFIXES):
+                continue # scratch files - the same filter the watcher snapshot applies
+            # the one stat per file - it serves the cache check, the mtime/size recorded in the
+            # cloud db, and the "is this really a file" test below
+            try:
+                st = os.stat(os.path.join(self.latus_folder, partial_path))
+            except OSError:
+                continue # went away between the walk (or notification) and now
+            if not stat.S_ISREG(st.st_mode):
+                continue # the watcher reports folders too; only files get synced
+            statted.append((partial_path, st))
+            hash = self.hash_cache.get(partial_path, st)
+            if hash is None:
+                hash = self._db_recorded_hash(partial_path, st)
+                if hash is not None:
+                    self.hash_cache.put(partial_path, st, hash) # next time it's a plain cache hit
+            if hash is not None:
+                hashes[partial_path] = hash
+            else:
+                misses.append((partial_path, st))
+        batch = core.hash.calc_sha512_batch([os.path.join(self.latus_folder, partial_path)
+                                             for partial_path, _ in misses])
+        for (partial_path, st), (hash_bytes, _) in zip(misses, batch):
+            if hash_bytes is not None:
+                hash = hash_bytes.hex() # cloud filenames and the json db use the hex form
+                self.hash_cache.put(partial_path, st, hash)
+                hashes[partial_path] = hash
+        return [(partial_path, hashes.get(partial_path), st)
+                for partial_path, st in statted]
+
+    def _db_recorded_hash(self, partial_path, st):
+        """
+        Second chance for a file the hash cache doesn't know - typically the first run on a
+        machine whose files were extracted from the cloud (extraction restores mtimes).  If the
+        newest version in the file's cloud db records the same mtime and size the file has on
+        disk, its hash is our hash and the file doesn't need reading.
+        :param partial_path: path of the file relative to the latus folder
+        :param st: os.stat result for the local file
+        :return: hash (hex) or None if the db can't vouch for this exact file
+        """
+        file_as_cloud_folder = os.path.join(self.cloud_folder, partial_path)
+        try:
+            db = self.read_database(file_as_cloud_folder)
+        except OSError:
+            return None # no cloud db yet - a genuinely new file
+        version = db['versions'][-1] # last entry in the list is most recent
+        if version['size'] == st.st_size and version['mtime'] == st.st_mtime:
+            return version['hash']
+        return None
+
     def sync(self, added = None, deleted = None):
         """
         Sync new or updated files (both local and cloud).
+        :param added: partial paths the folder watch reported as new - when given, only those are
+        processed on the local side instead of walking (and stat'ing) the entire tree
+        :param deleted: partial paths the folder watch reported as removed - unused for now
+        (deletion propagation is still a todo), accepted so the watcher can hand us both lists
         """
+        self._dir_listings.clear() # re-snapshot the cloud listings each sweep
 
         # new or updated local files
-        local_walker = core.walker.Walker(self.latus_folder)
-        for partial_path in local_walker:
+        if added is None:
+            local_paths = list(core.walker.Walker(self.latus_folder))
+        else:
+            # incremental - one file changing shouldn't cost a rescan of all N files
+            # (_hash_all's stat weeds out folders and paths that have already vanished)
+            local_paths = list(added)
+        results = self._hash_all(local_paths)
+        # the cloud-side updates stay serial - one writer for the folders and json dbs
+        for partial_path, hash, st in results:
             # this is where we use the local _file_ name to create the cloud _folder_ where the .zips and metadata reside
-            full_path = local_walker.full_path(partial_path)
-            file_as_cloud_folder = os.path.join(self.get_cloud_folder(), partial_path)
-            if not os.path.exists(file_as_cloud_folder):
-                os.makedirs(file_as_cloud_folder)
+            file_as_cloud_folder = os.path.join(self.cloud_folder, partial_path)
+            parent_folder, folder_name = os.path.split(file_as_cloud_folder)
+            if folder_name not in self._listing(parent_folder):
+                # exist_ok since the snapshot can be a sweep behind another node
+                os.makedirs(file_as_cloud_folder, exist_ok=True)
+                self._listing(parent_folder).add(folder_name)
                 if self.verbose:
                     print('new local', partial_path)
-            hash, _ = core.hash.calc_sha512(full_path)
             if hash is not None:
-                cloud_zip_file = os.path.join(file_as_cloud_folder, hash + '.zip')
-                if not os.path.exists(cloud_zip_file):
+                zip_name = self.zip_file_name(hash)
+                cloud_zip_file = os.path.join(file_as_cloud_folder, zip_name)
+                folder_names = self._listing(file_as_cloud_folder)
+                # archives written before the truncation used the full 128-char name
+                if zip_name not in folder_names and (hash + '.zip') not in folder_names:
                     if self.verbose:
                         print('writing', partial_path, '(', cloud_zip_file, ')')
-                    compressor = core.compression.Compression(self.password, self.verbose)
-                    # Input to archive program (7z) is relative to the latus folder.  Note that we have to explicitly
-                    # give the full abs path of the archive itself since it's in a different folder.
-                    compressor.compress(self.latus_folder, partial_path, os.path.abspath(cloud_zip_file))
-                    mtime = os.path.getmtime(full_path)
-                    size = os.path.getsize(full_path)
-                    self.update_database(partial_path, file_as_cloud_folder, hash, mtime, size)
+                    # Input to archive program (7z) is relative to the latus folder.  Note that the archive path
+                    # must be absolute since it's in a different folder - it is, because cloud_root was normalized.
+                    self.get_compression().compress(self.latus_folder, partial_path, cloud_zip_file)
+                    folder_names.add(zip_name)
+                    self.update_database(partial_path, file_as_cloud_folder, hash, st.st_mtime, st.st_size)
+        self.hash_cache.save()
 
         # new or updated cloud files
         # todo: we're actually only interested in dirs here ... make Walker have a dirs only mode
-        cloud_walker = core.walker.Walker(self.get_cloud_folder(), do_dirs=True)
+        cloud_walker = core.walker.Walker(self.cloud_folder, do_dirs=True)
+        folder_sep = core.util.get_folder_sep()
         for partial_path in cloud_walker:
-            full_path = cloud_walker.full_path(partial_path)
-            if os.path.isdir(full_path):
+            # Walker already marks folders with a trailing separator, so testing for that saves
+            # the per-entry isdir (a stat for every zip and db file in the cloud folder)
+            if partial_path.endswith(folder_sep):
+                partial_path = partial_path[:-1]
+                full_path = cloud_walker.full_path(partial_path)
                 print('checking for new cloud files', 'full_path', full_path)
-                file_as_cloud_folder = os.path.join(self.get_cloud_folder(), partial_path)
+                file_as_cloud_folder = os.path.join(self.cloud_folder, partial_path)
+                db_file_path = os.path.join(file_as_cloud_folder, self.DATABASE_FILE_NAME)
+                try:
+                    db_mtime_ns = os.stat(db_file_path).st_mtime_ns
+                except OSError:
+                    continue # no db yet - another node is mid-way through creating this folder
+                settled = self._cloud_settled.get(db_file_path)
+                if settled is not None and settled[0] == db_mtime_ns and os.path.exists(settled[1]):
+                    continue # no node has written a newer version and our copy is still in place
                 db = self.read_database(file_as_cloud_folder)
                 file_path = db['path']
                 version = db['versions'][-1] # last entry in the list is most recent
                 hash = version['hash']
-                # todo: compare hashes
                 dest_path = os.path.join(self.latus_folder, file_path)
-                if not os.path.exists(dest_path):
+                try:
+                    dest_st = os.stat(dest_path)
+                except OSError:
+                    dest_st = None
+                if dest_st is not None:
+                    # compare our copy's hash to the newest cloud version - via the hash cache
+                    # this is a stat, not a re-read of the file
+                    local_hash = self.hash_cache.get(file_path, dest_st)
+                    if local_hash is None:
+                        hash_bytes, _ = core.hash.calc_sha512(dest_path)
+                        if hash_bytes is not None:
+                            local_hash = hash_bytes.hex()
+                            self.hash_cache.put(file_path, dest_st, local_hash)
+                    if local_hash is not None and local_hash != hash:
+                        # we never clobber a local copy, so until real conflict handling exists
+                        # just say so (once per db change - the settled marker below keeps this
+                        # from repeating every sweep)
+                        core.logger.log.warn('sync: local "%s" differs from the newest cloud version', dest_path)
+                else:
                     print('extracting', dest_path)
-                    extractor = core.compression.Compression(self.password, self.verbose)
-                    cloud_zip_file = os.path.join(file_as_cloud_folder, hash + '.zip')
-                    extractor.expand(self.latus_folder, os.path.abspath(cloud_zip_file))
+                    cloud_zip_file = os.path.join(file_as_cloud_folder, self.zip_file_name(hash))
+                    if not os.path.exists(cloud_zip_file):
+                        # archive written before the truncation
+                        cloud_zip_file = os.path.join(file_as_cloud_folder, hash + '.zip')
+                    self.get_compression().expand(self.latus_folder, cloud_zip_file)
+                if os.path.exists(dest_path):
+                    self._cloud_settled[db_file_path] = (db_mtime_ns, dest_path)
+        self.hash_cache.save() # the comparison above may have added entries
 
     def update_database(self, partial_path, file_as_cloud_folder, hash, mtime, size):
         db_file_path = os.path.join(file_as_cloud_folder, self.DATABASE_FILE_NAME)
-        if os.path.exists(db_file_path):
-            with open(db_file_path) as f:
-                db_info = json.load(f)
-        else:
-            db_info = {'path' : partial_path, 'versions' : []}
+        try:
+            # goes through the mtime-validated cache, so the usual read-modify-write here costs
+            # a stat rather than an open plus a json parse
+            db_info = self.read_database(file_as_cloud_folder)
+        except OSError:
+            db_info = {'path' : partial_path, 'versions' : []} # first version of this file
         info = {'size' : size, 'hash' : hash, 'mtime' : mtime}
         db_info['versions'].append(info)
-        with open(db_file_path, 'w') as f:
+        # write to the side and swap into place - another node reading (or this process dying)
+        # mid-write must never see a truncated db.  os.replace is atomic on both Windows and posix.
+        tmp_file_path = db_file_path + '.tmp'
+        with open(tmp_file_path, 'w') as f:
             json.dump(db_info, f, indent = 4)
+        os.replace(tmp_file_path, db_file_path)
+        # keep the cache warm so the next read doesn't have to re-parse our own write
+        self._db_cache[db_file_path] = (os.stat(db_file_path).st_mtime_ns, db_info)
 
     def read_database(self, file_as_cloud_folder):
         db_file_path = os.path.join(file_as_cloud_folder, self.DATABASE_FILE_NAME)
+        mtime_ns = os.stat(db_file_path).st_mtime_ns
+        cached = self._db_cache.get(db_file_path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
         with open(db_file_path) as f:
             db = json.load(f)
+        self._db_cache[db_file_path] = (mtime_ns, db)
         return db
\ No newline at end of file
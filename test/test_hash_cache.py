@@ -0,0 +1,46 @@
+import os
+
+import core.sync
+
+
+def write_cache_test_file(folder, name, contents):
+    p = os.path.join(str(folder), name)
+    with open(p, 'wb') as f:
+        f.write(contents)
+    return p
+
+
+def test_hash_cache_round_trip(tmp_path):
+    cache_file = os.path.join(str(tmp_path), 'cache.json')
+    data_file = write_cache_test_file(tmp_path, 'a.txt', b'a')
+    st = os.stat(data_file)
+    cache = core.sync.HashCache(cache_file)
+    assert(cache.get('a.txt', st) is None) # an empty cache can't vouch for anything
+    cache.put('a.txt', st, 'somehash')
+    assert(cache.get('a.txt', st) == 'somehash')
+    cache.save()
+    # a fresh instance reads the saved entries back
+    reloaded = core.sync.HashCache(cache_file)
+    assert(reloaded.get('a.txt', st) == 'somehash')
+
+
+def test_hash_cache_invalidation(tmp_path):
+    cache_file = os.path.join(str(tmp_path), 'cache.json')
+    data_file = write_cache_test_file(tmp_path, 'a.txt', b'a')
+    st = os.stat(data_file)
+    cache = core.sync.HashCache(cache_file)
+    cache.put('a.txt', st, 'somehash')
+    # same size but a different mtime - the cache must refuse to vouch
+    os.utime(data_file, (st.st_atime, st.st_mtime + 1))
+    assert(cache.get('a.txt', os.stat(data_file)) is None)
+    # a different size as well
+    write_cache_test_file(tmp_path, 'a.txt', b'ab')
+    assert(cache.get('a.txt', os.stat(data_file)) is None)
+
+
+def test_hash_cache_missing_or_bad_file(tmp_path):
+    # a missing or unparsable cache file just means starting empty
+    cache = core.sync.HashCache(os.path.join(str(tmp_path), 'nonexistent.json'))
+    assert(cache.entries == {})
+    bad_file = write_cache_test_file(tmp_path, 'bad.json', b'not json')
+    assert(core.sync.HashCache(bad_file).entries == {})